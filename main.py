@@ -8,14 +8,26 @@ from bs4 import BeautifulSoup
 import yaml
 import glob
 import json
+import copy
 import hashlib
 import subprocess
 import smtplib
 import re
+import threading
+import time
+import socket
+import uuid
 import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from contextlib import contextmanager
 from email.mime.text import MIMEText
 from email.header import Header
 
+try:
+    import fcntl
+except ImportError:  # Windows 本地运行时没有 fcntl，租约检查退化为无锁
+    fcntl = None
+
 # 强制设置终端输出为 UTF-8 编码，防止 Windows 乱码
 if sys.stdout.encoding != 'utf-8':
     try:
@@ -30,6 +42,7 @@ DATA_DIR = "data"
 RECORD_FILE = os.path.join(DATA_DIR, "processed_records.json")
 SINOPEC_HISTORY_FILE = os.path.join(DATA_DIR, "sinopec_butadiene_history.json")
 NR_HISTORY_FILE = os.path.join(DATA_DIR, "natural_rubber_history.json")
+LEASE_FILE = os.path.join(DATA_DIR, ".run.lease")  # 单实例运行租约 (不提交到 Git)
 PUSHPLUS_TOKEN = os.environ.get("PUSHPLUS_TOKEN")
 
 # 邮件配置 (从环境变量读取)
@@ -37,6 +50,108 @@ EMAIL_SENDER = os.environ.get("EMAIL_SENDER")
 EMAIL_AUTH_CODE = os.environ.get("EMAIL_AUTH_CODE")
 EMAIL_RECEIVER = os.environ.get("EMAIL_RECEIVER")
 
+# 运行时限配置：整轮运行共享一个截止时间，避免超出 5 分钟的 cron 间隔
+RUN_BUDGET_SECONDS = int(os.environ.get("RUN_BUDGET_SECONDS", "240"))
+RESERVED_SECONDS = 45        # 为推送、保存状态和 git 提交预留的时间
+MIN_NOTIFY_TIMEOUT = 5       # 推送至少给出的超时 (秒)
+HTTP_RETRIES = 2             # 幂等 GET 请求的重试次数
+BREAKER_THRESHOLD = 3        # 同一站点连续多少次调用 (含重试) 失败后熔断
+BREAKER_COOLDOWN = 120       # 熔断后多久允许再次尝试 (秒)
+
+# 汇总推送配置：同一轮 (或常驻模式下 DIGEST_WINDOW 秒内) 的报告合并为一条消息发送
+# 报告只在每轮抓取时产生，窗口短于 SERVE_INTERVAL 时无法合并跨轮的报告
+DIGEST_MODE = os.environ.get("DIGEST_MODE", "0") == "1"
+DIGEST_WINDOW = int(os.environ.get("DIGEST_WINDOW", "0"))
+
+# 本地读取服务配置 (python main.py --serve)
+API_HOST = os.environ.get("API_HOST", "127.0.0.1")
+API_PORT = int(os.environ.get("API_PORT", "8026"))
+SERVE_INTERVAL = int(os.environ.get("SERVE_INTERVAL", "300"))  # 常驻模式下两次抓取的间隔 (秒)
+SNAPSHOT_HISTORY_LIMIT = 30  # 内存中保留的历史条数
+
+# 租约有效期：超过一轮运行预算仍未释放，视为上一轮已异常退出，可被接管
+LEASE_TTL = RUN_BUDGET_SECONDS + 60
+
+class BudgetExhausted(requests.exceptions.Timeout):
+    """本轮运行的时间预算已耗尽"""
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """目标站点处于熔断状态，本次请求直接放弃"""
+
+class RunBudget:
+    """单轮运行的时间预算，根据剩余时间推导每次请求的超时"""
+
+    def __init__(self, total=RUN_BUDGET_SECONDS, reserve=RESERVED_SECONDS):
+        self.deadline = time.monotonic() + total
+        self.reserve = reserve
+
+    def remaining(self):
+        return self.deadline - time.monotonic()
+
+    def timeout_for(self, cap, use_reserve=False):
+        """返回不超过 cap 的超时；抓取类请求不得占用预留时间"""
+        available = self.remaining() if use_reserve else self.remaining() - self.reserve
+        return max(0.0, min(cap, available))
+
+    def notify_timeout(self, cap):
+        """推送/保存使用预留时间，且至少保证 MIN_NOTIFY_TIMEOUT"""
+        return max(MIN_NOTIFY_TIMEOUT, self.timeout_for(cap, use_reserve=True))
+
+class CircuitBreaker:
+    """按站点统计连续失败次数，超过阈值后在冷却期内拒绝请求"""
+
+    def __init__(self, threshold=BREAKER_THRESHOLD, cooldown=BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = {}
+        self.open_until = {}
+
+    def allow(self, host):
+        return time.monotonic() >= self.open_until.get(host, 0)
+
+    def record_success(self, host):
+        self.failures.pop(host, None)
+        self.open_until.pop(host, None)
+
+    def record_failure(self, host):
+        self.failures[host] = self.failures.get(host, 0) + 1
+        if self.failures[host] >= self.threshold:
+            self.open_until[host] = time.monotonic() + self.cooldown
+            print(f"[{host}] 连续失败 {self.failures[host]} 次，熔断 {self.cooldown} 秒。")
+
+# 当前运行的时间预算 (main() 启动时重置) 与站点熔断器
+RUN_BUDGET = RunBudget()
+BREAKER = CircuitBreaker()
+
+def fetch_url(url, headers, cap=15):
+    """带时间预算、重试与熔断的 GET 请求 (仅用于幂等的页面抓取)"""
+    host = urllib.parse.urlparse(url).netloc
+    last_error = None
+    for attempt in range(HTTP_RETRIES + 1):
+        if not BREAKER.allow(host):
+            raise CircuitOpenError(f"{host} 处于熔断状态")
+        timeout = RUN_BUDGET.timeout_for(cap)
+        if timeout <= 0:
+            raise BudgetExhausted(f"运行时间预算不足，放弃请求 {url}")
+        try:
+            resp = requests.get(url, headers=headers, timeout=timeout)
+            if resp.status_code < 500:
+                BREAKER.record_success(host)
+                return resp
+            last_error = requests.exceptions.HTTPError(f"{resp.status_code} Server Error", response=resp)
+        except requests.exceptions.RequestException as e:
+            last_error = e
+        # 指数退避，剩余预算不足以再试一次时直接放弃
+        backoff = 0.5 * (2 ** attempt)
+        if attempt == HTTP_RETRIES or RUN_BUDGET.timeout_for(cap) <= backoff:
+            break
+        time.sleep(backoff)
+    # 每次调用最多计一次失败，单个坏链接的重试不会熔断整个站点
+    BREAKER.record_failure(host)
+    if isinstance(last_error, requests.exceptions.HTTPError):
+        return last_error.response
+    raise last_error
+
 def get_sinopec_factory_price():
     """获取中石化丁二烯当日出厂价 (从资讯列表页抓取)"""
     list_url = "https://www.100ppi.com/news/list-14--369-1.html"
@@ -48,7 +163,7 @@ def get_sinopec_factory_price():
     today_md = f"{today.month}月{today.day}日"
     
     try:
-        resp = requests.get(list_url, headers=headers, timeout=15)
+        resp = fetch_url(list_url, headers)
         resp.encoding = 'utf-8'
         soup = BeautifulSoup(resp.text, 'html.parser')
         
@@ -70,7 +185,7 @@ def get_sinopec_factory_price():
 
         # 进入详情页抓取具体厂家价格
         print(f"发现今日中石化资讯: {target_url}，正在解析详情...")
-        detail_resp = requests.get(target_url, headers=headers, timeout=15)
+        detail_resp = fetch_url(target_url, headers)
         detail_resp.encoding = 'utf-8'
         detail_soup = BeautifulSoup(detail_resp.text, 'html.parser')
         content = detail_soup.get_text()
@@ -166,7 +281,7 @@ def get_natural_rubber_price():
     today_title_str = f"（{date_pattern}）"
     
     try:
-        resp = requests.get(list_url, headers=headers, timeout=15)
+        resp = fetch_url(list_url, headers)
         resp.encoding = 'utf-8'
         soup = BeautifulSoup(resp.text, 'html.parser')
         
@@ -187,7 +302,7 @@ def get_natural_rubber_price():
             return None
 
         print(f"发现今日天然橡胶资讯: {target_url}，正在解析详情...")
-        detail_resp = requests.get(target_url, headers=headers, timeout=15)
+        detail_resp = fetch_url(target_url, headers)
         detail_resp.encoding = 'utf-8'
         detail_soup = BeautifulSoup(detail_resp.text, 'html.parser')
         
@@ -290,6 +405,13 @@ def generate_nr_html(today_nr, history):
     
     return html
 
+def load_history(path):
+    """读取历史价格记录，文件不存在时返回空列表"""
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
 def load_configs():
     """从 COMM-CFG 目录加载所有 yaml 配置文件"""
     configs = []
@@ -315,6 +437,94 @@ def get_item_hash(item):
     unique_str = f"{item['date_str']}_{item['name']}_{item['price']}_{item['company']}_{item['spec']}"
     return hashlib.md5(unique_str.encode('utf-8')).hexdigest()
 
+def write_json_atomic(path, data):
+    """先写临时文件再原子替换，避免中断或并发写入产生半截 JSON"""
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    tmp_path = f"{path}.{os.getpid()}.{uuid.uuid4().hex[:8]}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=2, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+class RunLease:
+    """单实例运行租约：同一时间只允许一轮 main() 处理状态、推送和提交"""
+
+    def __init__(self, path=LEASE_FILE, ttl=LEASE_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.token = uuid.uuid4().hex
+
+    def _read(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception:
+            return None
+
+    def _payload(self):
+        return {
+            "token": self.token,
+            "pid": os.getpid(),
+            "host": socket.gethostname(),
+            "expires": time.time() + self.ttl,
+        }
+
+    @contextmanager
+    def _guard(self):
+        """对 <租约>.lock 加排他文件锁，保证检查与接管过程互斥"""
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(f"{self.path}.lock", 'a') as f:
+            if fcntl:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def _expires(self, holder):
+        """租约到期时间；文件为空或损坏时按文件修改时间推算"""
+        if holder is not None:
+            return holder.get("expires", 0)
+        try:
+            return os.path.getmtime(self.path) + self.ttl
+        except FileNotFoundError:
+            return 0
+
+    def acquire(self):
+        """获取租约，成功返回 True；已被其他未过期的运行持有时返回 False"""
+        with self._guard():
+            try:
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                holder = self._read()
+                if self._expires(holder) > time.time():
+                    if holder:
+                        print(f"运行租约由 {holder.get('host')}:{holder.get('pid')} 持有，本次运行退出。")
+                    return False
+                owner = f"{holder.get('host')}:{holder.get('pid')}" if holder else "内容无效"
+                print(f"发现过期租约 ({owner})，接管运行。")
+                write_json_atomic(self.path, self._payload())
+                return True
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(self._payload(), f)
+            return True
+
+    def release(self):
+        """只释放自己持有的租约，避免误删被接管后的新租约"""
+        with self._guard():
+            holder = self._read()
+            if holder and holder.get("token") == self.token:
+                try:
+                    os.remove(self.path)
+                except FileNotFoundError:
+                    pass
+
 def load_processed_records():
     """加载已处理记录"""
     if not os.path.exists(RECORD_FILE):
@@ -330,11 +540,7 @@ def load_processed_records():
 
 def save_processed_records(records):
     """保存记录到文件"""
-    if not os.path.exists(DATA_DIR):
-        os.makedirs(DATA_DIR)
-    
-    with open(RECORD_FILE, 'w', encoding='utf-8') as f:
-        json.dump(records, f, indent=2, ensure_ascii=False)
+    write_json_atomic(RECORD_FILE, records)
 
 def git_commit_changes():
     """将状态文件的变更提交回 Git"""
@@ -344,9 +550,9 @@ def git_commit_changes():
         subprocess.run(["git", "config", "--global", "user.email", "github-actions[bot]@users.noreply.github.com"], check=True)
         
         # Add & Commit & Push
-        subprocess.run(["git", "add", DATA_DIR], check=True) # 提交整个 data 目录（包含历史记录）
-        subprocess.run(["git", "commit", "-m", "Auto-update prices and history [skip ci]"], check=False)
-        subprocess.run(["git", "push"], check=True)
+        subprocess.run(["git", "add", DATA_DIR], check=True, timeout=RUN_BUDGET.notify_timeout(15)) # 提交整个 data 目录（包含历史记录）
+        subprocess.run(["git", "commit", "-m", "Auto-update prices and history [skip ci]"], check=False, timeout=RUN_BUDGET.notify_timeout(15))
+        subprocess.run(["git", "push"], check=True, timeout=RUN_BUDGET.notify_timeout(60))
         print("已成功提交状态记录更新。")
     except Exception as e:
         print(f"Git 提交失败 (本地运行可忽略): {e}")
@@ -366,7 +572,7 @@ def get_price_data(config):
     all_prices = []
     
     try:
-        response = requests.get(url, headers=headers, timeout=15)
+        response = fetch_url(url, headers)
         response.encoding = 'utf-8'
         
         if response.status_code != 200:
@@ -506,7 +712,7 @@ def send_notification(html_content):
     tz = pytz.timezone('Asia/Shanghai')
     title = f"📢 丁二烯价格更新 ({datetime.now(tz).strftime('%H:%M')})"
     try:
-        resp = requests.post("http://www.pushplus.plus/send", json={"token": PUSHPLUS_TOKEN, "title": title, "content": html_content, "template": "html"}, timeout=20)
+        resp = requests.post("http://www.pushplus.plus/send", json={"token": PUSHPLUS_TOKEN, "title": title, "content": html_content, "template": "html"}, timeout=RUN_BUDGET.notify_timeout(20))
         if resp.status_code != 200:
             print(f"微信推送返回非 200 响应: {resp.text}")
         return resp.status_code == 200
@@ -523,7 +729,7 @@ def send_email_notification(html_content):
     msg['From'] = EMAIL_SENDER
     msg['To'] = EMAIL_RECEIVER
     try:
-        server = smtplib.SMTP_SSL("smtp.qq.com", 465, timeout=15)
+        server = smtplib.SMTP_SSL("smtp.qq.com", 465, timeout=RUN_BUDGET.notify_timeout(15))
         server.login(EMAIL_SENDER, EMAIL_AUTH_CODE)
         server.sendmail(EMAIL_SENDER, [EMAIL_RECEIVER], msg.as_string())
         try: server.quit()
@@ -534,7 +740,284 @@ def send_email_notification(html_content):
         print(f"邮件推送异常: {e}")
         return False
 
-def main():
+def deliver_report(key, html, on_sent, records, digest=None):
+    """发送一份报告；成功后执行 on_sent(records)，保存状态并提交
+
+    传入 digest 时只加入汇总，由 digest.flush() 统一发送，同样返回 True。
+    """
+    if digest is not None:
+        digest.add(key, html, on_sent)
+        return True
+    if send_notification(html) or send_email_notification(html):
+        on_sent(records)
+        save_processed_records(records)
+        git_commit_changes()
+        return True
+    return False
+
+class ReportDigest:
+    """汇总推送：收集多份报告，合并为一条消息发送，并只保存、提交一次"""
+
+    def __init__(self, window=DIGEST_WINDOW):
+        self.window = window
+        self.sections = {}  # key -> (html, on_sent)，同类报告以最新一份为准
+        self.opened_at = None
+
+    def add(self, key, html, on_sent):
+        if not self.sections:
+            self.opened_at = time.monotonic()
+        self.sections[key] = (html, on_sent)
+
+    def due(self):
+        return bool(self.sections) and time.monotonic() - self.opened_at >= self.window
+
+    def remaining(self):
+        """距离汇总窗口到期的秒数，没有待发内容时返回 None"""
+        if not self.sections:
+            return None
+        return max(0.0, self.window - (time.monotonic() - self.opened_at))
+
+    def render(self):
+        return "<hr>".join(html for html, _ in self.sections.values())
+
+    def flush(self, records):
+        """发送汇总消息；失败时保留待发内容，下一轮再试"""
+        if not self.sections:
+            return False
+        html = self.render()
+        print(f"正在发送汇总报告 (共 {len(self.sections)} 份)...")
+        if not (send_notification(html) or send_email_notification(html)):
+            return False
+        for _, on_sent in self.sections.values():
+            on_sent(records)
+        save_processed_records(records)
+        git_commit_changes()
+        self.sections.clear()
+        self.opened_at = None
+        return True
+
+class PriceSnapshotStore:
+    """在内存中保存最新一次解析结果与近期历史，供本地读取服务使用"""
+
+    def __init__(self, history_limit=SNAPSHOT_HISTORY_LIMIT):
+        self.history_limit = history_limit
+        self.cond = threading.Condition()
+        self.version = 0
+        self.latest = {"sinopec": None, "natural_rubber": None, "market": []}
+        self.history = {"sinopec": [], "natural_rubber": []}
+        self.updated_at = None
+        self._body = None
+        self._etag = None
+
+    def publish(self, key, value):
+        """更新某一类最新数据 (sinopec / natural_rubber / market)
+
+        保存副本，调用方之后修改原对象不会影响已缓存的 body/ETag。
+        """
+        value = copy.deepcopy(value)
+        with self.cond:
+            self.latest[key] = value
+            self._bump()
+
+    def publish_history(self, key, history):
+        """更新某一类历史记录，只保留最近 history_limit 条"""
+        with self.cond:
+            self.history[key] = list(history[-self.history_limit:])
+            self._bump()
+
+    def _bump(self):
+        tz = pytz.timezone('Asia/Shanghai')
+        self.version += 1
+        self.updated_at = datetime.now(tz).strftime('%Y-%m-%d %H:%M:%S')
+        # 序列化结果按版本缓存，读请求直接返回字节串
+        self._body = None
+        self._etag = None
+        self.cond.notify_all()
+
+    def render(self):
+        """返回 (etag, body)，同一版本只序列化一次"""
+        with self.cond:
+            if self._body is None:
+                payload = {
+                    "version": self.version,
+                    "updated_at": self.updated_at,
+                    "latest": self.latest,
+                    "history": self.history,
+                }
+                self._body = json.dumps(payload, ensure_ascii=False, default=str).encode('utf-8')
+                self._etag = f'"{self.version}-{hashlib.md5(self._body).hexdigest()[:12]}"'
+            return self._etag, self._body
+
+    def wait_for_change(self, etag, timeout):
+        """阻塞直到 ETag 变化或超时，返回最新的 (etag, body)"""
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while self.render()[0] == etag:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            return self.render()
+
+    def load_history_files(self):
+        """启动时从 data/ 目录预加载历史记录"""
+        self.publish_history("sinopec", load_history(SINOPEC_HISTORY_FILE))
+        self.publish_history("natural_rubber", load_history(NR_HISTORY_FILE))
+
+# 进程内共享的最新数据快照
+SNAPSHOT = PriceSnapshotStore()
+
+def make_api_handler(store):
+    """构造本地读取服务的请求处理类
+
+    GET /api/snapshot   最新数据 + 历史，支持 If-None-Match；带 ?wait=秒 时长轮询
+    GET /api/events     SSE 推送，每次数据更新发送一条 snapshot 事件
+    """
+    class PriceApiHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            parsed = urllib.parse.urlparse(self.path)
+            if parsed.path == "/api/snapshot":
+                self._snapshot(urllib.parse.parse_qs(parsed.query))
+            elif parsed.path == "/api/events":
+                self._events()
+            else:
+                self.send_error(404)
+
+        def _snapshot(self, query):
+            client_etag = self.headers.get("If-None-Match")
+            try:
+                wait = min(float(query.get("wait", ["0"])[0]), 60)
+            except ValueError:
+                wait = 0
+            if client_etag and wait > 0:
+                etag, body = store.wait_for_change(client_etag, wait)
+            else:
+                etag, body = store.render()
+            if client_etag == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", "no-cache")
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _events(self):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream; charset=utf-8")
+            self.send_header("Cache-Control", "no-cache")
+            self.end_headers()
+            etag = self.headers.get("Last-Event-ID")
+            try:
+                while True:
+                    new_etag, body = store.wait_for_change(etag, 15)
+                    if new_etag == etag:
+                        self.wfile.write(b": keep-alive\n\n")  # 心跳，防止连接被中间代理断开
+                    else:
+                        etag = new_etag
+                        self.wfile.write(f"id: {etag}\nevent: snapshot\n".encode('utf-8') + b"data: " + body + b"\n\n")
+                    self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+    return PriceApiHandler
+
+def serve_api(host=API_HOST, port=API_PORT, interval=SERVE_INTERVAL):
+    """常驻模式：启动本地 HTTP/JSON 读取服务，并定时执行 main() 刷新数据"""
+    SNAPSHOT.load_history_files()
+    server = ThreadingHTTPServer((host, port), make_api_handler(SNAPSHOT))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"本地价格读取服务已启动: http://{host}:{server.server_address[1]}/api/snapshot")
+    # 常驻模式下汇总跨越多轮运行，DIGEST_WINDOW 秒后统一发送
+    digest = ReportDigest(window=DIGEST_WINDOW) if DIGEST_MODE else None
+    next_run = time.monotonic()
+    try:
+        while True:
+            if time.monotonic() >= next_run:
+                next_run = time.monotonic() + interval
+                try:
+                    main(digest, serve=True)
+                except Exception as e:
+                    print(f"本轮抓取异常: {e}")
+            elif digest is not None and digest.due():
+                try:
+                    flush_digest(digest)
+                except Exception as e:
+                    print(f"汇总推送异常: {e}")
+            # 汇总窗口先到期时提前醒来发送；发送失败则留到下一轮抓取后再试
+            wait = next_run - time.monotonic()
+            pending = digest.remaining() if digest is not None else None
+            if pending:
+                wait = min(wait, pending)
+            time.sleep(max(wait, 0))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if digest is not None and digest.sections:
+            print(f"服务退出，发送尚未到期的汇总报告 (共 {len(digest.sections)} 份)...")
+            try:
+                if not flush_digest(digest):
+                    print("警告: 汇总报告未能发送，已丢弃。")
+            except Exception as e:
+                print(f"警告: 汇总报告发送异常，已丢弃: {e}")
+        server.shutdown()
+        server.server_close()
+
+def flush_digest(digest):
+    """在两轮抓取之间发送汇总 (需获取运行租约)，成功返回 True"""
+    global RUN_BUDGET
+    RUN_BUDGET = RunBudget()
+    lease = RunLease()
+    if not lease.acquire():
+        return False
+    try:
+        return digest.flush(load_processed_records())
+    finally:
+        lease.release()
+
+def main(digest=None, serve=False):
+    global RUN_BUDGET
+    RUN_BUDGET = RunBudget()
+    if digest is None and DIGEST_MODE:
+        # 单次运行：本轮结束时统一发送
+        digest = ReportDigest(window=0)
+    lease = RunLease()
+    if not lease.acquire():
+        return
+    try:
+        run_once(digest, serve)
+    finally:
+        lease.release()
+
+def refresh_snapshot(records, today_str, market_polled):
+    """常驻模式下补齐读取服务的当日快照，与是否推送无关
+
+    散户报价每轮都刷新；中石化/天然橡胶当日已推送但快照中缺失 (如进程中途启动) 时补抓一次。
+    """
+    for key, done_key, fetch in (("sinopec", "sinopec_done_date", get_sinopec_factory_price),
+                                 ("natural_rubber", "nr_done_date", get_natural_rubber_price)):
+        latest = SNAPSHOT.latest[key]
+        if records.get(done_key) == today_str and not (latest and latest.get("date") == today_str):
+            data = fetch()
+            if data:
+                SNAPSHOT.publish(key, data)
+
+    if not market_polled:
+        all_items = []
+        for cfg in load_configs(): all_items.extend(get_price_data(cfg))
+        organize_data(all_items, set(records["hashes"]))
+        SNAPSHOT.publish("market", all_items)
+
+def run_once(digest=None, serve=False):
+    """执行一轮监测 (需在持有运行租约时调用)；serve=True 时同时刷新读取服务快照"""
     tz = pytz.timezone('Asia/Shanghai')
     now = datetime.now(tz)
     today_str = now.strftime('%Y-%m-%d')
@@ -556,65 +1039,75 @@ def main():
             print("正在监测中石化丁二烯报价...")
             sinopec_data = get_sinopec_factory_price()
             if sinopec_data:
-                history = []
-                if os.path.exists(SINOPEC_HISTORY_FILE):
-                    with open(SINOPEC_HISTORY_FILE, 'r', encoding='utf-8') as f:
-                        history = json.load(f)
-                html = generate_sinopec_html(sinopec_data, history)
-                if send_notification(html) or send_email_notification(html):
+                SNAPSHOT.publish("sinopec", sinopec_data)
+                html = generate_sinopec_html(sinopec_data, load_history(SINOPEC_HISTORY_FILE))
+
+                def on_sinopec_sent(records, sinopec_data=sinopec_data):
+                    history = load_history(SINOPEC_HISTORY_FILE)
                     avg_p = sum(sinopec_data['prices'].values()) / len(sinopec_data['prices'])
                     history.append({"date": today_str, "price": int(avg_p), "is_sinopec": True})
-                    with open(SINOPEC_HISTORY_FILE, 'w', encoding='utf-8') as f:
-                        json.dump(history, f, indent=2, ensure_ascii=False)
+                    write_json_atomic(SINOPEC_HISTORY_FILE, history)
+                    SNAPSHOT.publish_history("sinopec", history)
                     records["sinopec_done_date"] = today_str
-                    sinopec_triggered = True
-                    save_processed_records(records)
-                    git_commit_changes()
+
+                sinopec_triggered = deliver_report("sinopec", html, on_sinopec_sent, records, digest)
 
     # --- 任务 2: 天然橡胶专场 ---
-    nr_triggered = False
     if records.get("nr_done_date") != today_str:
         if 9 <= now.hour <= 11: # 与中石化窗口一致
             print("正在监测天然橡胶当日动态...")
             nr_data = get_natural_rubber_price()
             if nr_data:
-                history = []
-                if os.path.exists(NR_HISTORY_FILE):
-                    with open(NR_HISTORY_FILE, 'r', encoding='utf-8') as f:
-                        history = json.load(f)
-                html = generate_nr_html(nr_data, history)
-                # 使用专门的标题推送
-                if send_notification(html) or send_email_notification(html):
+                SNAPSHOT.publish("natural_rubber", nr_data)
+                html = generate_nr_html(nr_data, load_history(NR_HISTORY_FILE))
+
+                def on_nr_sent(records, nr_data=nr_data):
                     print("今日天然橡胶报价已成功推送并归档。")
+                    history = load_history(NR_HISTORY_FILE)
                     avg_p = sum(nr_data['prices'].values()) / len(nr_data['prices'])
                     history.append({"date": today_str, "price": int(avg_p), "note": "Average"})
-                    with open(NR_HISTORY_FILE, 'w', encoding='utf-8') as f:
-                        json.dump(history, f, indent=2, ensure_ascii=False)
+                    write_json_atomic(NR_HISTORY_FILE, history)
+                    SNAPSHOT.publish_history("natural_rubber", history)
                     records["nr_done_date"] = today_str
-                    nr_triggered = True
-                    save_processed_records(records)
-                    git_commit_changes()
+
+                deliver_report("natural_rubber", html, on_nr_sent, records, digest)
 
     # --- 任务 3: 市场散户轮询 ---
-    # 如果中石化还没出，执行散户轮询
-    if records.get("sinopec_done_date") != today_str:
+    # 如果中石化还没出 (本轮也未发出或加入汇总)，执行散户轮询
+    market_polled = False
+    if records.get("sinopec_done_date") != today_str and not sinopec_triggered:
         print("执行常规散户丁二烯报价轮询...")
+        market_polled = True
         configs = load_configs()
         sent_hashes = set(records["hashes"])
         all_items = []
         for cfg in configs: all_items.extend(get_price_data(cfg))
         
         today_data, yesterday_data, new_count = organize_data(all_items, sent_hashes)
+        SNAPSHOT.publish("market", all_items)
         if new_count > 0:
             html = generate_html_report(today_data, yesterday_data)
-            if send_notification(html) or send_email_notification(html):
-                for item in today_data:
-                    if item.get('is_new'): records["hashes"].append(get_item_hash(item))
-                save_processed_records(records)
-                git_commit_changes()
+            new_hashes = [get_item_hash(item) for item in today_data if item.get('is_new')]
+
+            def on_market_sent(records, new_hashes=new_hashes):
+                if records["date"] != today_str:
+                    return
+                for h in new_hashes:
+                    if h not in records["hashes"]: records["hashes"].append(h)
+
+            deliver_report("market", html, on_market_sent, records, digest)
     else:
         if not sinopec_triggered:
             print("今日中石化报价已完成，散户常规轮询已跳过。")
 
+    if serve:
+        refresh_snapshot(records, today_str, market_polled)
+
+    if digest is not None and digest.due():
+        digest.flush(records)
+
 if __name__ == "__main__":
-    main()
+    if "--serve" in sys.argv:
+        serve_api()
+    else:
+        main()
@@ -3,7 +3,14 @@ from unittest.mock import patch, MagicMock
 from datetime import datetime, timedelta
 import pytz
 import main
+import yaml
 import os
+import json
+import tempfile
+import time
+import threading
+import urllib.request
+import urllib.error
 
 class TestPriceMonitor(unittest.TestCase):
     
@@ -108,5 +115,424 @@ class TestPriceMonitor(unittest.TestCase):
         mock_instance.login.assert_called_with("sender@qq.com", "authcode")
         mock_instance.sendmail.assert_called()
 
+    def test_run_budget_timeouts(self):
+        """测试运行预算：抓取请求不占用预留时间，推送至少有最小超时"""
+        budget = main.RunBudget(total=60, reserve=45)
+        self.assertLessEqual(budget.timeout_for(15), 15)
+        self.assertGreater(budget.timeout_for(15), 14)
+
+        budget = main.RunBudget(total=30, reserve=45)
+        self.assertEqual(budget.timeout_for(15), 0)
+        self.assertGreater(budget.timeout_for(20, use_reserve=True), 19)
+
+        budget = main.RunBudget(total=0, reserve=45)
+        self.assertEqual(budget.notify_timeout(20), main.MIN_NOTIFY_TIMEOUT)
+
+    @patch('main.time.sleep')
+    @patch('main.requests.get')
+    def test_fetch_url_retry_and_breaker(self, mock_get, mock_sleep):
+        """测试 GET 重试与站点熔断"""
+        budget = patch.object(main, 'RUN_BUDGET', main.RunBudget(total=240, reserve=45))
+        breaker = patch.object(main, 'BREAKER', main.CircuitBreaker(threshold=3, cooldown=120))
+        budget.start()
+        breaker.start()
+        self.addCleanup(budget.stop)
+        self.addCleanup(breaker.stop)
+
+        ok = MagicMock(status_code=200)
+        mock_get.side_effect = [main.requests.exceptions.ConnectionError("boom"), ok]
+        self.assertIs(main.fetch_url("https://example.com/a", {}), ok)
+        self.assertEqual(mock_get.call_count, 2)
+
+        # 单个链接重试耗尽只计一次失败，不会熔断整个站点
+        mock_get.reset_mock()
+        mock_get.side_effect = main.requests.exceptions.Timeout("slow")
+        with self.assertRaises(main.requests.exceptions.Timeout):
+            main.fetch_url("https://example.com/b", {})
+        self.assertEqual(mock_get.call_count, 3)
+        self.assertTrue(main.BREAKER.allow("example.com"))
+
+        # 多个链接连续失败达到阈值后熔断，后续请求不再发出
+        for path in ("c", "d"):
+            with self.assertRaises(main.requests.exceptions.Timeout):
+                main.fetch_url(f"https://example.com/{path}", {})
+        self.assertEqual(mock_get.call_count, 9)
+        with self.assertRaises(main.CircuitOpenError):
+            main.fetch_url("https://example.com/e", {})
+        self.assertEqual(mock_get.call_count, 9)
+
+    @patch('main.subprocess.run')
+    def test_git_commit_changes_budgeted(self, mock_run):
+        """测试 git add/commit/push 均带有预算内的超时"""
+        with patch.object(main, 'RUN_BUDGET', main.RunBudget(total=240, reserve=45)):
+            main.git_commit_changes()
+        git_calls = [c for c in mock_run.call_args_list if c.args[0][1] in ("add", "commit", "push")]
+        self.assertEqual(len(git_calls), 3)
+        for c in git_calls:
+            self.assertGreater(c.kwargs["timeout"], 0)
+
+    def test_run_lease_single_flight(self):
+        """测试运行租约：第二个运行无法获取，过期租约可被接管"""
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, ".run.lease")
+            first = main.RunLease(path=path, ttl=300)
+            second = main.RunLease(path=path, ttl=300)
+            self.assertTrue(first.acquire())
+            self.assertFalse(second.acquire())
+
+            # 模拟上一轮异常退出留下的过期租约
+            stale = first._payload()
+            stale["expires"] = 0
+            main.write_json_atomic(path, stale)
+            self.assertTrue(second.acquire())
+
+            # 旧持有者释放时不能删除新租约
+            first.release()
+            self.assertTrue(os.path.exists(path))
+            second.release()
+            self.assertFalse(os.path.exists(path))
+
+    def test_run_lease_empty_stale_file(self):
+        """测试运行租约：空的旧租约文件按修改时间判定过期并被接管"""
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, ".run.lease")
+            open(path, 'w').close()
+            # 刚创建的空文件视为仍被占用 (持有者可能尚未写入内容)
+            self.assertFalse(main.RunLease(path=path, ttl=300).acquire())
+            os.utime(path, (0, 0))
+            lease = main.RunLease(path=path, ttl=1)
+            self.assertTrue(lease.acquire())
+            self.assertEqual(lease._read()["token"], lease.token)
+
+    def test_run_lease_concurrent_takeover(self):
+        """测试运行租约：多个运行同时接管过期租约时只有一个成功"""
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, ".run.lease")
+            stale = main.RunLease(path=path, ttl=300)._payload()
+            stale["expires"] = 0
+            main.write_json_atomic(path, stale)
+
+            # 放慢接管写入，扩大竞争窗口
+            real_write = main.write_json_atomic
+
+            def slow_write(*args):
+                time.sleep(0.05)
+                real_write(*args)
+
+            slow = patch.object(main, 'write_json_atomic', slow_write)
+            slow.start()
+            self.addCleanup(slow.stop)
+
+            results = []
+            barrier = threading.Barrier(8)
+
+            def contend():
+                lease = main.RunLease(path=path, ttl=300)
+                barrier.wait()
+                try:
+                    results.append(lease.acquire())
+                except Exception as e:
+                    results.append(e)
+
+            threads = [threading.Thread(target=contend) for _ in range(8)]
+            for t in threads: t.start()
+            for t in threads: t.join()
+            self.assertEqual(sorted(results, key=str), [False] * 7 + [True])
+
+    def test_daily_workflow_serializes_runs(self):
+        """测试定时工作流：运行排队执行，且检出分支最新提交以读取上一轮的状态"""
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".github", "workflows", "daily.yml"), encoding='utf-8') as f:
+            workflow = yaml.safe_load(f)
+        self.assertFalse(workflow["concurrency"]["cancel-in-progress"])
+        checkout = next(step for step in workflow["jobs"]["send_morning_message"]["steps"]
+                        if step.get("uses", "").startswith("actions/checkout"))
+        self.assertEqual(checkout["with"]["ref"], "${{ github.ref_name }}")
+
+    def test_write_json_atomic(self):
+        """测试原子写入：内容完整且不残留临时文件"""
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "sub", "records.json")
+            main.write_json_atomic(path, {"date": "2026-01-01", "hashes": ["a"]})
+            with open(path, 'r', encoding='utf-8') as f:
+                self.assertEqual(json.load(f)["hashes"], ["a"])
+            self.assertEqual(os.listdir(os.path.dirname(path)), ["records.json"])
+
+    @patch('main.git_commit_changes')
+    @patch('main.save_processed_records')
+    @patch('main.send_email_notification', return_value=False)
+    @patch('main.send_notification', return_value=True)
+    def test_digest_coalesces_reports(self, mock_send, mock_email, mock_save, mock_git):
+        """测试汇总模式：多份报告合并为一次推送，状态只保存、提交一次"""
+        digest = main.ReportDigest(window=0)
+        records = {"date": "2026-01-01", "hashes": [], "sinopec_done_date": "", "nr_done_date": ""}
+
+        def mark(key):
+            return lambda r: r.update({key: "2026-01-01"})
+
+        main.deliver_report("sinopec", "<p>A</p>", mark("sinopec_done_date"), records, digest)
+        main.deliver_report("natural_rubber", "<p>B-old</p>", mark("nr_done_date"), records, digest)
+        main.deliver_report("natural_rubber", "<p>B</p>", mark("nr_done_date"), records, digest)
+        mock_send.assert_not_called()
+        self.assertTrue(digest.due())
+
+        self.assertTrue(digest.flush(records))
+        mock_send.assert_called_once_with("<p>A</p><hr><p>B</p>")
+        mock_save.assert_called_once_with(records)
+        mock_git.assert_called_once()
+        self.assertEqual(records["sinopec_done_date"], "2026-01-01")
+        self.assertEqual(records["nr_done_date"], "2026-01-01")
+        self.assertFalse(digest.due())
+
+        digest = main.ReportDigest(window=60)
+        self.assertIsNone(digest.remaining())
+        digest.add("market", "<p>C</p>", lambda r: None)
+        self.assertFalse(digest.due())
+        self.assertGreater(digest.remaining(), 59)
+
+    def test_serve_flushes_digest_on_window_and_shutdown(self):
+        """测试常驻模式：按汇总窗口提前醒来发送，退出时发送尚未到期的汇总"""
+        sleeps = []
+
+        def fake_main(digest, serve=False):
+            digest.add("sinopec", "<p>A</p>", lambda r: None)
+
+        def fake_sleep(seconds):
+            sleeps.append(seconds)
+            if len(sleeps) >= 2:
+                raise KeyboardInterrupt
+
+        with patch.object(main, 'DIGEST_MODE', True), patch.object(main, 'DIGEST_WINDOW', 30), \
+             patch.object(main.SNAPSHOT, 'load_history_files'), \
+             patch.object(main, 'main', side_effect=fake_main), \
+             patch.object(main.time, 'sleep', side_effect=fake_sleep), \
+             patch.object(main, 'flush_digest', return_value=True) as mock_flush:
+            main.serve_api(host="127.0.0.1", port=0, interval=300)
+
+        # 等待时长受汇总窗口限制，而非抓取间隔
+        self.assertLessEqual(sleeps[0], 30)
+        mock_flush.assert_called_once()
+        self.assertIn("sinopec", mock_flush.call_args[0][0].sections)
+
+    @patch('main.git_commit_changes')
+    @patch('main.save_processed_records')
+    @patch('main.send_email_notification', return_value=False)
+    @patch('main.send_notification', return_value=True)
+    def test_flush_digest_holds_lease(self, mock_send, mock_email, mock_save, mock_git):
+        """测试两轮之间的汇总发送：持有租约时发送，租约被占用时保留待发内容"""
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, ".run.lease")
+            records = {"date": "2026-01-15", "hashes": [], "sinopec_done_date": "", "nr_done_date": ""}
+            real_lease = main.RunLease
+            with patch.object(main, 'RunLease', lambda: real_lease(path=path, ttl=300)), \
+                 patch.object(main, 'load_processed_records', return_value=records):
+                digest = main.ReportDigest(window=0)
+                digest.add("sinopec", "<p>A</p>", lambda r: r.update({"sinopec_done_date": "2026-01-15"}))
+
+                holder = real_lease(path=path, ttl=300)
+                self.assertTrue(holder.acquire())
+                self.assertFalse(main.flush_digest(digest))
+                mock_send.assert_not_called()
+                holder.release()
+
+                self.assertTrue(main.flush_digest(digest))
+                mock_send.assert_called_once_with("<p>A</p>")
+                self.assertEqual(records["sinopec_done_date"], "2026-01-15")
+                self.assertIsNone(digest.remaining())
+                self.assertFalse(os.path.exists(path))
+
+    def _patch_run_env(self, tmp, sinopec=True, nr=True, market_items=(), hour=10, done_date=""):
+        """为 run_once 准备固定时间 (默认 10:00，处于监测窗口) 与模拟的抓取、推送"""
+        tz = pytz.timezone('Asia/Shanghai')
+        fixed_now = tz.localize(datetime(2026, 1, 15, hour, 0))
+
+        class FixedDatetime(datetime):
+            @classmethod
+            def now(cls, tz=None):
+                return fixed_now
+
+        sinopec_data = {"date": "2026-01-15", "prices": {"上海石化": 9100}, "url": "http://s"} if sinopec else None
+        nr_data = {"date": "2026-01-15", "prices": {"A(B)": 15000}, "url": "http://n"} if nr else None
+        self.records = {"date": "2026-01-15", "hashes": [], "sinopec_done_date": done_date, "nr_done_date": done_date}
+        mocks = {}
+        for name, kwargs in {
+            'datetime': dict(new=FixedDatetime),
+            'SNAPSHOT': dict(new=main.PriceSnapshotStore()),
+            'SINOPEC_HISTORY_FILE': dict(new=os.path.join(tmp, "sinopec.json")),
+            'NR_HISTORY_FILE': dict(new=os.path.join(tmp, "nr.json")),
+            'load_processed_records': dict(return_value=self.records),
+            'get_sinopec_factory_price': dict(return_value=sinopec_data),
+            'get_natural_rubber_price': dict(return_value=nr_data),
+            'load_configs': dict(return_value=[{"name": "丁二烯", "url": "http://m"}]),
+            'get_price_data': dict(return_value=[dict(item) for item in market_items]),
+            'send_notification': dict(return_value=True),
+            'send_email_notification': dict(return_value=False),
+            'save_processed_records': dict(),
+            'git_commit_changes': dict(),
+        }.items():
+            patcher = patch.object(main, name, **kwargs)
+            mocks[name] = patcher.start()
+            self.addCleanup(patcher.stop)
+        return mocks
+
+    def test_run_once_without_digest(self):
+        """测试常规模式：中石化与天然橡胶各推送一次，中石化完成后跳过散户轮询"""
+        with tempfile.TemporaryDirectory() as tmp:
+            mocks = self._patch_run_env(tmp)
+            main.run_once()
+
+            self.assertEqual(mocks['send_notification'].call_count, 2)
+            self.assertEqual(mocks['save_processed_records'].call_count, 2)
+            self.assertEqual(mocks['git_commit_changes'].call_count, 2)
+            mocks['get_price_data'].assert_not_called()
+            self.assertEqual(self.records["sinopec_done_date"], "2026-01-15")
+            self.assertEqual(self.records["nr_done_date"], "2026-01-15")
+            self.assertEqual(main.load_history(main.SINOPEC_HISTORY_FILE)[-1]["price"], 9100)
+
+    def test_run_once_digest_single_send(self):
+        """测试汇总模式：一轮只推送一次，且不额外执行散户轮询"""
+        with tempfile.TemporaryDirectory() as tmp:
+            mocks = self._patch_run_env(tmp)
+            main.run_once(main.ReportDigest(window=0))
+
+            mocks['send_notification'].assert_called_once()
+            html = mocks['send_notification'].call_args[0][0]
+            self.assertIn("中石化丁二烯出厂价更新报告", html)
+            self.assertIn("天然橡胶商品报价动态报告", html)
+            mocks['get_price_data'].assert_not_called()
+            mocks['save_processed_records'].assert_called_once_with(self.records)
+            mocks['git_commit_changes'].assert_called_once()
+            self.assertEqual(self.records["sinopec_done_date"], "2026-01-15")
+            self.assertEqual(self.records["nr_done_date"], "2026-01-15")
+            self.assertEqual(main.load_history(main.NR_HISTORY_FILE)[-1]["price"], 15000)
+
+    def test_run_once_digest_with_market(self):
+        """测试汇总模式：中石化未发布时，天然橡胶与散户报价合并推送并记录新指纹"""
+        item = {'date': datetime(2026, 1, 15).date(), 'date_str': '2026-01-15', 'name': '丁二烯',
+                'raw_name': '丁二烯', 'price': '9000', 'company': 'C', 'spec': 'S'}
+        with tempfile.TemporaryDirectory() as tmp:
+            mocks = self._patch_run_env(tmp, sinopec=False, market_items=[item])
+            main.run_once(main.ReportDigest(window=0))
+
+            mocks['send_notification'].assert_called_once()
+            html = mocks['send_notification'].call_args[0][0]
+            self.assertIn("天然橡胶商品报价动态报告", html)
+            self.assertIn("市场散户报价更新", html)
+            mocks['save_processed_records'].assert_called_once()
+            self.assertEqual(self.records["hashes"], [main.get_item_hash(item)])
+            self.assertEqual(self.records["sinopec_done_date"], "")
+
+    def test_run_once_serve_refreshes_snapshot_after_notified(self):
+        """测试常驻模式：当日已推送后仍刷新快照，且不再发送通知"""
+        item = {'date': datetime(2026, 1, 15).date(), 'date_str': '2026-01-15', 'name': '丁二烯',
+                'raw_name': '丁二烯', 'price': '9000', 'company': 'C', 'spec': 'S'}
+        with tempfile.TemporaryDirectory() as tmp:
+            mocks = self._patch_run_env(tmp, market_items=[item], hour=14, done_date="2026-01-15")
+            main.run_once(serve=True)
+
+            latest = main.SNAPSHOT.latest
+            self.assertEqual(latest["sinopec"]["prices"]["上海石化"], 9100)
+            self.assertEqual(latest["natural_rubber"]["prices"]["A(B)"], 15000)
+            self.assertEqual(latest["market"][0]["price"], "9000")
+            mocks['send_notification'].assert_not_called()
+            mocks['save_processed_records'].assert_not_called()
+
+            # 下一轮：中石化/天然橡胶已在快照中，不再补抓；散户报价继续轮询
+            main.run_once(serve=True)
+            mocks['get_sinopec_factory_price'].assert_called_once()
+            mocks['get_natural_rubber_price'].assert_called_once()
+            self.assertEqual(mocks['get_price_data'].call_count, 2)
+
+            # 非常驻模式保持原有行为，不做额外抓取
+            main.run_once()
+            self.assertEqual(mocks['get_price_data'].call_count, 2)
+
+    def test_snapshot_store_etag(self):
+        """测试快照 ETag：数据不变时稳定，发布新数据后变化"""
+        store = main.PriceSnapshotStore(history_limit=2)
+        etag1, body1 = store.render()
+        self.assertEqual(store.render()[0], etag1)
+
+        store.publish("sinopec", {"date": "2026-01-01", "prices": {"上海石化": 9100}, "url": "u"})
+        store.publish_history("sinopec", [{"date": d, "price": 1} for d in ("a", "b", "c")])
+        etag2, body2 = store.render()
+        self.assertNotEqual(etag1, etag2)
+        data = json.loads(body2)
+        self.assertEqual(data["latest"]["sinopec"]["prices"]["上海石化"], 9100)
+        self.assertEqual([h["date"] for h in data["history"]["sinopec"]], ["b", "c"])
+
+        # 长轮询超时后返回原 ETag
+        self.assertEqual(store.wait_for_change(etag2, 0.01)[0], etag2)
+
+    def _start_api(self, store):
+        server = main.ThreadingHTTPServer(("127.0.0.1", 0), main.make_api_handler(store))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return f"http://127.0.0.1:{server.server_address[1]}"
+
+    def test_snapshot_store_load_history_files(self):
+        """测试预加载历史：与 load_history 一致，缺失文件视为空"""
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "sinopec.json")
+            main.write_json_atomic(path, [{"date": "2026-01-01", "price": 9100}])
+            with patch.object(main, 'SINOPEC_HISTORY_FILE', path), \
+                 patch.object(main, 'NR_HISTORY_FILE', os.path.join(tmp, "missing.json")):
+                store = main.PriceSnapshotStore()
+                store.load_history_files()
+            self.assertEqual(store.history["sinopec"], [{"date": "2026-01-01", "price": 9100}])
+            self.assertEqual(store.history["natural_rubber"], [])
+
+    def test_snapshot_store_copies_published_value(self):
+        """测试发布后修改原对象不影响快照内容"""
+        store = main.PriceSnapshotStore()
+        items = [{"name": "丁二烯", "is_new": False}]
+        store.publish("market", items)
+        items[0]["is_new"] = True
+        self.assertFalse(json.loads(store.render()[1])["latest"]["market"][0]["is_new"])
+
+    def test_snapshot_api_conditional_get(self):
+        """测试本地读取服务：200 带 ETag，If-None-Match 命中返回 304"""
+        store = main.PriceSnapshotStore()
+        store.publish("market", [{"name": "丁二烯", "date": datetime(2026, 1, 1).date()}])
+        url = self._start_api(store) + "/api/snapshot"
+        with urllib.request.urlopen(url) as resp:
+            etag = resp.headers["ETag"]
+            self.assertEqual(json.loads(resp.read())["latest"]["market"][0]["date"], "2026-01-01")
+        req = urllib.request.Request(url, headers={"If-None-Match": etag})
+        with self.assertRaises(urllib.error.HTTPError) as ctx:
+            urllib.request.urlopen(req)
+        self.assertEqual(ctx.exception.code, 304)
+
+    def test_snapshot_api_long_poll(self):
+        """测试长轮询：等待期间发布新数据，返回 200 与新的 ETag"""
+        store = main.PriceSnapshotStore()
+        old_etag = store.render()[0]
+        url = self._start_api(store) + "/api/snapshot?wait=5"
+        timer = threading.Timer(0.1, store.publish, ("sinopec", {"prices": {"上海石化": 9100}}))
+        timer.start()
+        self.addCleanup(timer.cancel)
+        req = urllib.request.Request(url, headers={"If-None-Match": old_etag})
+        with urllib.request.urlopen(req, timeout=5) as resp:
+            self.assertEqual(resp.status, 200)
+            self.assertNotEqual(resp.headers["ETag"], old_etag)
+            self.assertEqual(resp.headers["ETag"], store.render()[0])
+            self.assertEqual(json.loads(resp.read())["latest"]["sinopec"]["prices"]["上海石化"], 9100)
+
+    def test_snapshot_api_events(self):
+        """测试 SSE：发布新数据后收到 snapshot 事件"""
+        store = main.PriceSnapshotStore()
+        url = self._start_api(store) + "/api/events"
+        old_etag = store.render()[0]
+        timer = threading.Timer(0.1, store.publish, ("natural_rubber", {"prices": {"A(B)": 15000}}))
+        timer.start()
+        self.addCleanup(timer.cancel)
+        req = urllib.request.Request(url, headers={"Last-Event-ID": old_etag})
+        with urllib.request.urlopen(req, timeout=5) as resp:
+            self.assertEqual(resp.status, 200)
+            self.assertEqual(resp.readline().decode('utf-8').strip(), f"id: {store.render()[0]}")
+            self.assertEqual(resp.readline().strip(), b"event: snapshot")
+            data = resp.readline().decode('utf-8')
+            self.assertIn("15000", data)
+
 if __name__ == '__main__':
     unittest.main()